@@ -28,10 +28,44 @@ def main():
                         help='JGI password',
                         type=str,
                         dest='jgi_password')
+    parser.add_argument('--disk-budget',
+                        help=('Hold back new per-sample jobs while projected '
+                              'size of output/ exceeds this many GB'),
+                        type=float,
+                        dest='disk_budget')
+    parser.add_argument('--clean-intermediates',
+                        help=('Remove intermediate BAM and gVCF files once '
+                              'all tasks that use them have finished'),
+                        action='store_true',
+                        dest='clean_intermediates')
     options = parser.parse_args()
     jgi_logon = options.jgi_logon
     jgi_password = options.jgi_password
 
+    # track intermediate files and disk use. Consumers are the names of the
+    # tasks below that read each artifact. check_pipeline only checks that
+    # they are wrapped tasks, so any new task that reads one of these files
+    # must be wrapped and added to its consumers here.
+    artifacts = functions.ArtifactManager(
+        budget_gb=options.disk_budget,
+        clean=options.clean_intermediates)
+    artifacts.register(
+        r'output/mark_duplicates_and_sort/.+\.deduped\.bam',
+        consumers=['split_trim'])
+    artifacts.register(
+        r'output/split_trim/.+\.split\.bam',
+        consumers=['uncalibrated_variants', 'covar_report',
+                   'second_pass_covar_report', 'recalibrate'])
+    artifacts.register(
+        r'output/recal/.+\.recal\.bam',
+        consumers=['variants'])
+    artifacts.register(
+        r'output/variants_uncalibrated/.+\.g\.vcf\.gz',
+        consumers=['uncalibrated_variants_merged'])
+    artifacts.register(
+        r'output/variants/.+\.g\.vcf\.gz',
+        consumers=['variants_merged'])
+
     ##################
     # PIPELINE STEPS #
     ##################
@@ -51,6 +85,9 @@ def main():
 
     # subset the files while the pipeline is in development. Make this equal
     # to the raw_files to run the whole pipline.
+    # n.b. with --clean-intermediates, adding files to the subset reruns the
+    # merge steps over intermediates that have already been cleaned up.
+    # Delete the empty placeholders (or don't clean) before widening it.
     # active_raw_files = [x for x in raw_files if
     #                     'G1' in x or 'G4' in x or 'J1' in x or 'J4' in x]
     active_raw_files = raw_files
@@ -113,11 +150,14 @@ def main():
     # mark duplicates with picard
     deduped = main_pipeline.transform(
         name='dedupe',
-        task_func=functions.generate_job_function(
-            job_script='src/sh/mark_duplicates_and_sort',
-            job_name='dedupe',
-            job_type='transform',
-            cpus_per_task=2),
+        task_func=artifacts.wrap(
+            functions.generate_job_function(
+                job_script='src/sh/mark_duplicates_and_sort',
+                job_name='dedupe',
+                job_type='transform',
+                cpus_per_task=2),
+            task_name='dedupe',
+            hold=True),
         input=mapped_raw,
         filter=ruffus.regex(r"data/bam/(.*).Aligned.out.bam"),
         output=(r"output/mark_duplicates_and_sort/\1.deduped.bam"))
@@ -125,11 +165,14 @@ def main():
     # Split'N'Trim and reassign mapping qualities
     split_and_trimmed = main_pipeline.transform(
         name='split_trim',
-        task_func=functions.generate_job_function(
-            job_script='src/sh/split_trim',
-            job_name='split_trim',
-            job_type='transform',
-            cpus_per_task=2),
+        task_func=artifacts.wrap(
+            functions.generate_job_function(
+                job_script='src/sh/split_trim',
+                job_name='split_trim',
+                job_type='transform',
+                cpus_per_task=2),
+            task_name='split_trim',
+            hold=True),
         input=deduped,
         add_inputs=ruffus.add_inputs(ref_fa),
         filter=ruffus.formatter(
@@ -159,7 +202,8 @@ def main():
     # call variants without recalibration tables
     uncalibrated_variants = main_pipeline.transform(
         name='uncalibrated_variants',
-        task_func=call_variants,
+        task_func=artifacts.wrap(
+            call_variants, task_name='uncalibrated_variants', hold=True),
         input=split_and_trimmed,
         add_inputs=ruffus.add_inputs([ref_fa, annot_bed]),
         filter=ruffus.formatter('output/split_trim/(?P<LIB>.+).split.bam'),
@@ -168,7 +212,8 @@ def main():
     # merge gVCF variants
     uncalibrated_variants_merged = main_pipeline.merge(
         name='uncalibrated_variants_merged',
-        task_func=merge_variants,
+        task_func=artifacts.wrap(
+            merge_variants, task_name='uncalibrated_variants_merged'),
         input=[uncalibrated_variants, ref_fa],
         output='output/variants_uncalibrated/variants_uncalibrated.vcf.gz')
 
@@ -196,7 +241,7 @@ def main():
     # create recalibration report with filtered variants
     covar_report = main_pipeline.merge(
         name='covar_report',
-        task_func=analyze_covar,
+        task_func=artifacts.wrap(analyze_covar, task_name='covar_report'),
         input=[split_and_trimmed, ref_fa, annot_bed,
                uncalibrated_variants_selected],
         output="output/covar_analysis/recal_data.table")
@@ -204,7 +249,8 @@ def main():
     # second pass to analyze covariation remaining after recalibration
     second_pass_covar_report = main_pipeline.merge(
         name='second_pass_covar_report',
-        task_func=analyze_covar,
+        task_func=artifacts.wrap(
+            analyze_covar, task_name='second_pass_covar_report'),
         input=[split_and_trimmed, ref_fa, annot_bed,
                uncalibrated_variants_filtered, covar_report],
         output="output/covar_analysis/post_recal_data.table")
@@ -225,11 +271,14 @@ def main():
     # recalibrate bases using recalibration report
     recalibrated = main_pipeline.transform(
         name='recalibrate',
-        task_func=functions.generate_job_function(
-            job_script='src/sh/recalibrate',
-            job_name='recalibrate',
-            job_type='transform',
-            cpus_per_task=2),
+        task_func=artifacts.wrap(
+            functions.generate_job_function(
+                job_script='src/sh/recalibrate',
+                job_name='recalibrate',
+                job_type='transform',
+                cpus_per_task=2),
+            task_name='recalibrate',
+            hold=True),
         input=split_and_trimmed,
         add_inputs=ruffus.add_inputs([ref_fa, covar_report]),
         filter=ruffus.formatter('output/split_trim/(?P<LIB>.+).split.bam'),
@@ -238,7 +287,8 @@ def main():
     # final variant calling
     variants = main_pipeline.transform(
         name='variants',
-        task_func=call_variants,
+        task_func=artifacts.wrap(
+            call_variants, task_name='variants', hold=True),
         input=recalibrated,
         add_inputs=ruffus.add_inputs(ref_fa, annot_bed),
         filter=ruffus.formatter('output/recal/(?P<LIB>.+).recal.bam'),
@@ -247,7 +297,7 @@ def main():
     # merge gVCF variants
     variants_merged = main_pipeline.merge(
         name='variants_merged',
-        task_func=merge_variants,
+        task_func=artifacts.wrap(merge_variants, task_name='variants_merged'),
         input=[variants, ref_fa],
         output='output/variants/variants.vcf.gz')
 
@@ -302,13 +352,21 @@ def main():
     # RUFFUS COMMANDS #
     ###################
 
+    # make sure the artifact consumers are wrapped tasks defined above
+    artifacts.check_pipeline(main_pipeline)
+
     # print the flowchart
     ruffus.pipeline_printout_graph(
         "ruffus/flowchart.pdf", "pdf",
         pipeline_name="5 accessions variant calling pipeline")
 
-    # run the pipeline
-    ruffus.cmdline.run(options, multithread=8)
+    # run the pipeline, then report intermediates that are left over. Don't
+    # clean up when ruffus only printed the pipeline and ran no jobs.
+    dry_run = options.just_print or options.flowchart
+    try:
+        ruffus.cmdline.run(options, multithread=8)
+    finally:
+        artifacts.report(clean=False if dry_run else None)
 
 if __name__ == "__main__":
     main()
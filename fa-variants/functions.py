@@ -6,6 +6,10 @@ import re
 import os
 import datetime
 import tempfile
+import json
+import threading
+import time
+import functools
 
 #############
 # UTILITIES #
@@ -351,3 +355,381 @@ def generate_queue_job_function(job_script, job_name, verbose=False):
                                       " failed with non-zero exit code")
 
     return job_function
+
+
+#######################
+# ARTIFACT MANAGEMENT #
+#######################
+
+# sizes of all files below a directory, keyed by path
+def file_sizes_under(path):
+    file_sizes = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            file_path = os.path.join(dirpath, name)
+            try:
+                if not os.path.islink(file_path):
+                    file_sizes[file_path] = os.path.getsize(file_path)
+            except FileNotFoundError:
+                # removed by a running job during the walk
+                pass
+    return(file_sizes)
+
+
+def print_artifact_message(message):
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    print('[', now, '] : ' + message)
+
+
+class ArtifactManager:
+    '''
+    Keep track of which tasks still consume each intermediate artifact, clean
+    up artifacts once all their consumers have finished and hold back new
+    jobs while the projected size of output_dir is over budget.
+    '''
+
+    def __init__(self, budget_gb=None, clean=False, output_dir='output',
+                 state_file='ruffus/artifacts.json', poll_interval=60,
+                 verbose=False):
+        # type: (float, bool, str, str, int, bool) -> NoneType
+        if budget_gb is None:
+            self.budget = None
+        else:
+            self.budget = int(budget_gb * 1e9)
+        self.clean = clean
+        self.output_dir = os.path.normpath(output_dir)
+        self.poll_interval = poll_interval
+        self.state_file = state_file
+        self.verbose = verbose
+        # (compiled regex, consumer task names) for each artifact type
+        self.artifact_types = []
+        # task names passed to wrap
+        self.wrapped_tasks = set()
+        # consumer task names that haven't finished with each artifact. This
+        # is saved to state_file so that consumers that finished in earlier
+        # runs, and are skipped by ruffus now, still count.
+        self.pending_consumers = {}
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as f:
+                self.pending_consumers = {
+                    x: set(y) for x, y in json.load(f).items()}
+        # peak bytes added to output_dir by each completed job, per task
+        self.bytes_produced = {}
+        # jobs that are currently running, keyed by (task_name, outputs)
+        self.running = {}
+        # sample names of every job started, running or finished
+        self.job_stems = set()
+        # file sizes under output_dir from the last walk
+        self.file_sizes = None
+        self.monitor = None
+        self.condition = threading.Condition()
+
+    def register(self, pattern, consumers):
+        # type: (str, list) -> NoneType
+        '''
+        Declare that artifacts with paths matching the regular expression
+        pattern are used by the tasks named in consumers.
+        '''
+        self.artifact_types.append((re.compile(pattern), list(consumers)))
+
+    def check_pipeline(self, pipeline):
+        '''
+        Check that every registered consumer name is a task in the ruffus
+        pipeline and that its job function is wrapped. This catches renamed
+        or unwrapped consumers. It does not look at the task graph, so a new
+        task that reads an artifact must be added to its consumers by hand;
+        wrapped tasks that aren't listed fail in check_inputs, but unwrapped
+        ones aren't detected.
+        '''
+        for artifact_regex, consumers in self.artifact_types:
+            for consumer in consumers:
+                if consumer not in pipeline.task_names:
+                    raise ValueError(
+                        'consumer ' + consumer + ' of ' +
+                        artifact_regex.pattern + ' is not a pipeline task')
+                if consumer not in self.wrapped_tasks:
+                    raise ValueError(
+                        'consumer ' + consumer + ' of ' +
+                        artifact_regex.pattern + ' is not wrapped')
+
+    def consumers_of(self, artifact):
+        for artifact_regex, consumers in self.artifact_types:
+            if artifact_regex.fullmatch(artifact):
+                return(consumers)
+        return(None)
+
+    def estimate(self, task_name, input_bytes):
+        # mean peak bytes per job so far. Until the first job of the task
+        # finishes, guess that it writes as much as it reads.
+        produced = self.bytes_produced.get(task_name, [])
+        if len(produced) == 0:
+            return(input_bytes)
+        return(sum(produced) // len(produced))
+
+    def job_growth(self, job, file_sizes):
+        '''
+        Bytes a running job has added to its output directories, including
+        indexes, logs and intermediates. Files named after the job's sample
+        belong to it; new files not named after any job's sample, e.g. in a
+        shared tmp/, are split between the running jobs that write to the
+        same directory.
+        '''
+        if job['baseline'] is None:
+            return(0)
+        growth = 0
+        for path, size in file_sizes.items():
+            if not any(path.startswith(x + os.sep) for x in job['dirs']):
+                continue
+            added = size - job['baseline'].get(path, 0)
+            if added <= 0:
+                continue
+            name = os.path.basename(path)
+            if name.startswith(job['stem'] + '.'):
+                growth += added
+            elif not any(name.startswith(x + '.') for x in self.job_stems):
+                sharers = [x for x in self.running.values() if
+                           any(path.startswith(y + os.sep)
+                               for y in x['dirs'])]
+                growth += added // len(sharers)
+        return(growth)
+
+    def update_sizes(self):
+        # walk output_dir without holding the lock, then update running jobs
+        file_sizes = file_sizes_under(self.output_dir)
+        with self.condition:
+            self.file_sizes = file_sizes
+            for job in self.running.values():
+                job['growth'] = self.job_growth(job, file_sizes)
+                job['peak'] = max(job['peak'], job['growth'])
+            self.condition.notify_all()
+
+    def monitor_sizes(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.update_sizes()
+
+    def start_monitor(self):
+        # file_sizes is filled in before the monitor is published, so no job
+        # can see a started monitor without sizes
+        with self.condition:
+            if self.monitor is not None:
+                return
+        file_sizes = file_sizes_under(self.output_dir)
+        with self.condition:
+            if self.monitor is not None:
+                return
+            self.file_sizes = file_sizes
+            self.monitor = threading.Thread(target=self.monitor_sizes,
+                                            daemon=True)
+            self.monitor.start()
+
+    def projected_use(self, estimate):
+        '''
+        Current size of output_dir, plus what running jobs have still to
+        write, plus the estimate for a new job. The running jobs' partial
+        output is already included in the current size.
+        '''
+        used = sum(self.file_sizes.values())
+        remaining = sum(max(0, x['reserved'] - x['growth'])
+                        for x in self.running.values())
+        return(used + remaining + estimate)
+
+    def start_job(self, job_key, task_name, input_files, output_files,
+                  hold):
+        '''
+        Register a running job. If hold is True, first wait until its
+        projected output fits in the budget. Jobs are never held back if
+        nothing else is running, because no running job could free up space
+        for them.
+        '''
+        input_bytes = sum(os.path.getsize(x) for x in input_files
+                          if os.path.isfile(x))
+        output_dirs = set(os.path.dirname(x) for x in output_files)
+        with self.condition:
+            while True:
+                estimate = self.estimate(task_name, input_bytes)
+                if (not hold or self.budget is None or
+                        len(self.running) == 0):
+                    break
+                projected = self.projected_use(estimate)
+                if projected <= self.budget:
+                    break
+                if self.verbose:
+                    print_artifact_message(
+                        'Holding ' + task_name + ' job, projected disk use ' +
+                        str(projected) + ' bytes, budget ' +
+                        str(self.budget) + ' bytes')
+                self.condition.wait(self.poll_interval)
+            stem = os.path.basename(output_files[0]).split('.')[0]
+            self.job_stems.add(stem)
+            self.running[job_key] = {
+                'task_name': task_name,
+                'stem': stem,
+                'dirs': output_dirs,
+                'baseline': None,
+                'reserved': estimate,
+                'growth': 0,
+                'peak': 0}
+        # record what was in the output directories when the job started
+        baseline = {}
+        for output_dir in output_dirs:
+            baseline.update(file_sizes_under(output_dir))
+        with self.condition:
+            self.running[job_key]['baseline'] = baseline
+
+    def finish(self, job_key, task_name, input_files, output_files):
+        # measure the job one last time and reset consumers of its outputs
+        self.update_sizes()
+        with self.condition:
+            job_bytes = self.running[job_key]['peak']
+            self.bytes_produced.setdefault(task_name, []).append(job_bytes)
+            for artifact in output_files:
+                consumers = self.consumers_of(artifact)
+                if consumers is not None:
+                    self.pending_consumers[artifact] = set(consumers)
+            # release inputs
+            finished_artifacts = []
+            for artifact in input_files:
+                consumers = self.consumers_of(artifact)
+                if consumers is None:
+                    continue
+                pending = self.pending_consumers.setdefault(
+                    artifact, set(consumers))
+                pending.discard(task_name)
+                if len(pending) == 0:
+                    finished_artifacts.append(artifact)
+            self.save_state()
+        print_artifact_message(
+            'Task ' + task_name + ' used up to ' + str(job_bytes) +
+            ' bytes in ' + self.output_dir)
+        if self.clean:
+            self.remove_artifacts(finished_artifacts)
+
+    def save_state(self):
+        # called with the lock held
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({x: sorted(y) for x, y in
+                       self.pending_consumers.items()}, f, indent=1)
+        os.replace(tmp_file, self.state_file)
+
+    def remove_artifacts(self, artifacts):
+        # clean up and forget artifacts that have no pending consumers
+        for artifact in artifacts:
+            self.remove_artifact(artifact)
+        with self.condition:
+            for artifact in artifacts:
+                self.pending_consumers.pop(artifact, None)
+            self.save_state()
+
+    def report(self, clean=None):
+        # type: (bool) -> NoneType
+        '''
+        Call when the pipeline stops. Clean up artifacts whose consumers all
+        finished in earlier runs and log artifacts that are still waiting on
+        consumers, or that were never seen by a wrapped job. Pass
+        clean=False to only log, e.g. after a dry run.
+        '''
+        if clean is None:
+            clean = self.clean
+        with self.condition:
+            finished_artifacts = [x for x, y in
+                                  self.pending_consumers.items()
+                                  if len(y) == 0]
+            waiting = {x: y for x, y in self.pending_consumers.items()
+                       if len(y) > 0}
+        if clean:
+            self.remove_artifacts(finished_artifacts)
+        for artifact in sorted(waiting):
+            print_artifact_message(
+                'Keeping ' + artifact + ', still needed by ' +
+                ', '.join(sorted(waiting[artifact])))
+        for path, size in sorted(file_sizes_under(self.output_dir).items()):
+            if (size > 0 and self.consumers_of(path) is not None and
+                    path not in self.pending_consumers):
+                print_artifact_message(
+                    'Keeping ' + path + ', not tracked (made before '
+                    'artifact tracking started?)')
+
+    def end_job(self, job_key):
+        with self.condition:
+            self.running.pop(job_key, None)
+            self.condition.notify_all()
+
+    def remove_artifact(self, artifact):
+        '''
+        Truncate an artifact to an empty placeholder and delete its index.
+        The placeholder keeps its timestamp so that ruffus still considers
+        downstream tasks up to date.
+        '''
+        if not os.path.isfile(artifact):
+            return
+        freed = os.path.getsize(artifact)
+        artifact_stat = os.stat(artifact)
+        with open(artifact, 'wb'):
+            pass
+        os.utime(artifact, ns=(artifact_stat.st_atime_ns,
+                               artifact_stat.st_mtime_ns))
+        # picard and gatk write x.bai, tabix writes x.gz.tbi
+        index_files = [os.path.splitext(artifact)[0] + '.bai',
+                       artifact + '.bai',
+                       artifact + '.tbi']
+        for index_file in index_files:
+            if os.path.isfile(index_file):
+                freed += os.path.getsize(index_file)
+                os.remove(index_file)
+        print_artifact_message(
+            'Removed ' + artifact + ', freed ' + str(freed) + ' bytes')
+
+    def check_inputs(self, task_name, input_files):
+        '''
+        Fail before submitting the job if the task reads an artifact it isn't
+        registered for, or if an input is an empty placeholder left by
+        remove_artifact, e.g. because adding samples made a merge task rerun
+        over artifacts that have already been cleaned up.
+        '''
+        for artifact in input_files:
+            consumers = self.consumers_of(artifact)
+            if consumers is None:
+                continue
+            if task_name not in consumers:
+                raise ValueError(
+                    'task ' + task_name + ' reads ' + artifact + ' but is '
+                    'not registered as one of its consumers')
+            if os.path.isfile(artifact) and os.path.getsize(artifact) == 0:
+                raise ValueError(
+                    'input ' + artifact + ' to task ' + task_name +
+                    ' was removed by --clean-intermediates. Delete it so '
+                    'that ruffus rebuilds it, then rerun the pipeline')
+
+    def wrap(self, task_func, task_name, hold=False):
+        # type: (function, str, bool) -> function
+        '''
+        Wrap a transform or merge job function so that its output is
+        tracked, its inputs are released when it finishes and, if hold is
+        True, it waits for disk budget before it starts.
+        '''
+        self.wrapped_tasks.add(task_name)
+
+        @functools.wraps(task_func)
+        def job_function(input_files, output_files, *extras):
+            input_files_flat = [os.path.normpath(x) for x in
+                                flatten_list([input_files])]
+            output_files_flat = [os.path.normpath(x) for x in
+                                 flatten_list([output_files])]
+            self.check_inputs(task_name, input_files_flat)
+            job_key = (task_name, tuple(output_files_flat))
+            self.start_monitor()
+            self.start_job(job_key, task_name, input_files_flat,
+                           output_files_flat, hold)
+            try:
+                task_func(input_files, output_files, *extras)
+                self.finish(job_key, task_name, input_files_flat,
+                            output_files_flat)
+            finally:
+                self.end_job(job_key)
+
+        return job_function
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'fa-variants'))
+import functions  # noqa: E402
+
+SPLIT_BAM = 'output/split_trim/B1.split.bam'
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('output/split_trim')
+    return(tmp_path)
+
+
+def make_manager(**kwargs):
+    manager = functions.ArtifactManager(
+        state_file='ruffus/artifacts.json', poll_interval=0.01, **kwargs)
+    manager.register(r'output/split_trim/.+\.split\.bam',
+                     consumers=['first_reader', 'second_reader'])
+    return(manager)
+
+
+def write_file(path, n_bytes):
+    with open(path, 'wb') as f:
+        f.write(b'x' * n_bytes)
+
+
+def produce_split(input_files, output_files):
+    write_file(output_files, 100)
+    write_file(os.path.splitext(output_files)[0] + '.bai', 10)
+
+
+def read_split(input_files, output_files):
+    pass
+
+
+def test_artifact_cleaned_after_last_consumer(workdir):
+    manager = make_manager(clean=True)
+    manager.wrap(produce_split, 'split_trim')('in.bam', SPLIT_BAM)
+    mtime = os.stat(SPLIT_BAM).st_mtime_ns
+
+    manager.wrap(read_split, 'first_reader')([SPLIT_BAM, 'ref.fa'], 'a.vcf')
+    assert os.path.getsize(SPLIT_BAM) == 100
+    assert os.path.isfile('output/split_trim/B1.split.bai')
+
+    manager.wrap(read_split, 'second_reader')((SPLIT_BAM,), 'b.table')
+    assert os.path.getsize(SPLIT_BAM) == 0
+    assert os.stat(SPLIT_BAM).st_mtime_ns == mtime
+    assert not os.path.isfile('output/split_trim/B1.split.bai')
+
+
+def test_artifact_kept_without_clean(workdir):
+    manager = make_manager()
+    manager.wrap(produce_split, 'split_trim')('in.bam', SPLIT_BAM)
+    manager.wrap(read_split, 'first_reader')(SPLIT_BAM, 'a.vcf')
+    manager.wrap(read_split, 'second_reader')(SPLIT_BAM, 'b.table')
+    assert os.path.getsize(SPLIT_BAM) == 100
+
+
+def test_placeholder_input_fails(workdir):
+    manager = make_manager(clean=True)
+    manager.wrap(produce_split, 'split_trim')('in.bam', SPLIT_BAM)
+    manager.wrap(read_split, 'first_reader')(SPLIT_BAM, 'a.vcf')
+    manager.wrap(read_split, 'second_reader')(SPLIT_BAM, 'b.table')
+    with pytest.raises(ValueError, match=SPLIT_BAM):
+        manager.wrap(read_split, 'first_reader')(SPLIT_BAM, 'a.vcf')
+
+
+def test_unregistered_reader_fails(workdir):
+    manager = make_manager()
+    manager.wrap(produce_split, 'split_trim')('in.bam', SPLIT_BAM)
+    with pytest.raises(ValueError, match='not registered'):
+        manager.wrap(read_split, 'other_reader')(SPLIT_BAM, 'c.vcf')
+
+
+def test_consumers_survive_restart(workdir):
+    manager = make_manager(clean=True)
+    manager.wrap(produce_split, 'split_trim')('in.bam', SPLIT_BAM)
+    manager.wrap(read_split, 'first_reader')(SPLIT_BAM, 'a.vcf')
+
+    # first_reader is skipped by ruffus in the resumed run
+    resumed_manager = make_manager(clean=True)
+    resumed_manager.wrap(read_split, 'second_reader')(SPLIT_BAM, 'b.table')
+    assert os.path.getsize(SPLIT_BAM) == 0
+
+
+def test_report(workdir, capsys):
+    manager = make_manager()
+    manager.wrap(produce_split, 'split_trim')('in.bam', SPLIT_BAM)
+    manager.wrap(read_split, 'first_reader')(SPLIT_BAM, 'a.vcf')
+    write_file('output/split_trim/B2.split.bam', 100)
+    manager.report()
+    out = capsys.readouterr().out
+    assert 'Keeping ' + SPLIT_BAM + ', still needed by second_reader' in out
+    assert 'Keeping output/split_trim/B2.split.bam, not tracked' in out
+
+    # consumers all finished without --clean-intermediates, then clean
+    manager.wrap(read_split, 'second_reader')(SPLIT_BAM, 'b.table')
+    assert os.path.getsize(SPLIT_BAM) == 100
+    make_manager(clean=True).report()
+    assert os.path.getsize(SPLIT_BAM) == 0
+
+
+def test_report_dry_run_keeps_artifacts(workdir):
+    manager = make_manager()
+    manager.wrap(produce_split, 'split_trim')('in.bam', SPLIT_BAM)
+    manager.wrap(read_split, 'first_reader')(SPLIT_BAM, 'a.vcf')
+    manager.wrap(read_split, 'second_reader')(SPLIT_BAM, 'b.table')
+    make_manager(clean=True).report(clean=False)
+    assert os.path.getsize(SPLIT_BAM) == 100
+
+
+def test_job_bytes_include_indexes_and_intermediates(workdir):
+    manager = make_manager()
+
+    def dedupe(input_files, output_files):
+        intermediate = 'output/split_trim/B1.rg_added_sorted.bam'
+        write_file(intermediate, 500)
+        produce_split(input_files, output_files)
+        # a monitor poll while the intermediate exists
+        manager.update_sizes()
+        os.remove(intermediate)
+
+    manager.wrap(dedupe, 'split_trim')('in.bam', SPLIT_BAM)
+    assert manager.bytes_produced['split_trim'] == [610]
+
+
+def run_held_jobs(manager, n_jobs, job):
+    # each job reads a 900-byte input, so the first jobs are estimated
+    # from input size
+    for x in range(n_jobs):
+        write_file('in' + str(x) + '.bam', 900)
+    job_function = manager.wrap(job, 'split_trim', hold=True)
+    errors = []
+
+    def run_job(x):
+        try:
+            job_function('in' + str(x) + '.bam',
+                         'output/split_trim/B' + str(x) + '.split.bam')
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_job, args=(x,))
+               for x in range(n_jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # fail on errors raised inside the job threads
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def test_jobs_held_over_budget(workdir):
+    manager = make_manager(budget_gb=1000 / 1e9)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def job(input_files, output_files):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        assert len(manager.running) == 1
+        write_file(output_files, 900)
+        # give held jobs a chance to start if the budget let them
+        time.sleep(0.05)
+        assert len(manager.running) == 1
+        with lock:
+            running[0] -= 1
+
+    run_held_jobs(manager, 6, job)
+    assert max_running[0] == 1
+    assert manager.bytes_produced['split_trim'] == [900] * 6
+
+
+def test_jobs_run_together_within_budget(workdir):
+    manager = make_manager(budget_gb=1)
+    barrier = threading.Barrier(6, timeout=5)
+
+    def job(input_files, output_files):
+        # only passes if all six jobs are running at once
+        barrier.wait()
+        write_file(output_files, 900)
+
+    run_held_jobs(manager, 6, job)
+    assert manager.bytes_produced['split_trim'] == [900] * 6
+
+
+def test_running_job_counted_once(workdir):
+    manager = make_manager(budget_gb=1)
+    write_file(SPLIT_BAM, 600)
+    manager.update_sizes()
+    manager.running[('split_trim', (SPLIT_BAM,))] = {
+        'task_name': 'split_trim', 'stem': 'B1', 'dirs': set(),
+        'baseline': {}, 'reserved': 1000, 'growth': 600, 'peak': 600}
+    assert manager.projected_use(estimate=50) == 600 + 400 + 50
+
+
+class FakePipeline:
+    task_names = {'split_trim', 'first_reader', 'second_reader'}
+
+
+def test_check_pipeline(workdir):
+    manager = make_manager()
+    manager.wrap(read_split, 'first_reader')
+    with pytest.raises(ValueError, match='second_reader'):
+        manager.check_pipeline(FakePipeline())
+    manager.wrap(read_split, 'second_reader')
+    manager.check_pipeline(FakePipeline())
+    manager.register(r'output/recal/.+\.recal\.bam', consumers=['variants'])
+    with pytest.raises(ValueError, match='not a pipeline task'):
+        manager.check_pipeline(FakePipeline())